@@ -0,0 +1,34 @@
+# Copyright: (c) 2023, Hasni Mehdi <hasnimehdi@outlook.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+__metaclass__ = type
+
+
+class ModuleDocFragment(object):
+    """
+    Options shared by the keepass modules to reuse opened databases
+    """
+
+    DOCUMENTATION = r'''
+options:
+    key_cache:
+        description:
+            - Persist the transformed master key in C(~/.cache/ansible-keepass) (mode 0600) to skip the key derivation on later runs.
+            - Anyone able to read the cached key can decrypt the database without its password.
+        required: false
+        type: bool
+        default: false
+    daemon:
+        description:
+            - Keep the opened database in a background process reached through a Unix socket of the current user.
+            - Later tasks reuse the process instead of opening the database again.
+        required: false
+        type: bool
+        default: false
+    daemon_timeout:
+        description: Number of idle seconds after which the background process exits.
+        required: false
+        type: int
+        default: 300
+'''
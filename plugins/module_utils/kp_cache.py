@@ -0,0 +1,117 @@
+# Copyright: (c) 2023, Hasni Mehdi <hasnimehdi@outlook.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import hashlib
+import mmap
+import os
+import threading
+
+from pykeepass import PyKeePass
+
+from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_fastkey import open_db
+
+__metaclass__ = type
+
+# Opened databases keyed by (real path, mtime, password digest)
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def _cache_key(db_path: str, db_password: str) -> tuple:
+    """
+    Build the cache key of a database
+    Args:
+        db_path: Keepass database path
+        db_password: Keepass database password
+    Returns: tuple
+    """
+    return (os.path.realpath(db_path),
+            os.stat(db_path).st_mtime_ns,
+            hashlib.blake2b(db_password.encode(), digest_size=16).digest())
+
+
+def _open_mmap(db_path: str) -> mmap.mmap:
+    """
+    Map a database file read-only in memory
+    Args:
+        db_path: Keepass database path
+    Returns: mmap.mmap
+    """
+    fd = os.open(db_path, os.O_RDONLY)
+    try:
+        mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+
+    # The whole file is parsed sequentially right after mapping it
+    if hasattr(mm, 'madvise'):
+        for advice in ('MADV_SEQUENTIAL', 'MADV_WILLNEED'):
+            if hasattr(mmap, advice):
+                mm.madvise(getattr(mmap, advice))
+
+    return mm
+
+
+def get_db(db_path: str, db_password: str, key_cache: bool = False) -> PyKeePass:
+    """
+    Return an opened Keepass database, the key derivation is only performed on the first access
+    or when the database file has been modified.
+    Args:
+        db_path: Keepass database path
+        db_password: Keepass database password
+        key_cache: Persist the transformed key on disk to skip the key derivation on later opens
+    Returns: PyKeePass
+    """
+    key = _cache_key(db_path, db_password)
+
+    with _LOCK:
+        db = _CACHE.get(key)
+        if db is None:
+            with _open_mmap(db_path) as mm:
+                if key_cache:
+                    db = open_db(mm, db_path, db_password)
+                else:
+                    db = PyKeePass(filename=mm, password=db_password)
+
+            # Point the database back to its file so save() and reload() keep working
+            db.filename = db_path
+
+            # Drop stale handles of the same database
+            for stale in [k for k in _CACHE if k[0] == key[0] and k[2] == key[2]]:
+                del _CACHE[stale]
+            _CACHE[key] = db
+
+    return db
+
+
+def update_db(db_path: str, db_password: str, db: PyKeePass):
+    """
+    Store a database handle under the current mtime of its file, must be called after saving the database.
+    Args:
+        db_path: Keepass database path
+        db_password: Keepass database password
+        db: Keepass database
+    """
+    key = _cache_key(db_path, db_password)
+
+    with _LOCK:
+        for stale in [k for k in _CACHE if k[0] == key[0] and k[2] == key[2]]:
+            del _CACHE[stale]
+        _CACHE[key] = db
+
+
+def invalidate_db(db_path: str, db_password: str):
+    """
+    Drop the cached handles of a database, the next access reloads it from disk.
+    Must be called when a cached handle was modified without being saved.
+    Args:
+        db_path: Keepass database path
+        db_password: Keepass database password
+    """
+    real_path = os.path.realpath(db_path)
+    digest = hashlib.blake2b(db_password.encode(), digest_size=16).digest()
+
+    with _LOCK:
+        for stale in [k for k in _CACHE if k[0] == real_path and k[2] == digest]:
+            del _CACHE[stale]
@@ -0,0 +1,320 @@
+# Copyright: (c) 2023, Hasni Mehdi <hasnimehdi@outlook.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import socket
+import stat
+import struct
+
+from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_cache import get_db
+
+__metaclass__ = type
+
+# Message length prefix
+_HEADER = struct.Struct('!I')
+
+
+class KeePassDaemonError(Exception):
+    """
+    Error raised by a request served by the daemon
+    """
+
+
+def _socket_dir() -> str:
+    """
+    Return the directory of the daemon sockets, only accessible by the current user.
+    The user runtime directory is used when available, the user cache directory otherwise.
+    Returns: str
+    """
+    base = os.environ.get('XDG_RUNTIME_DIR') or '/run/user/%d' % os.getuid()
+    if os.path.isdir(base):
+        run_dir = os.path.join(base, 'ansible-keepass')
+    else:
+        cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        run_dir = os.path.join(cache, 'ansible-keepass', 'run')
+    os.makedirs(run_dir, mode=0o700, exist_ok=True)
+
+    # Never talk to sockets in a directory another user could have prepared
+    st = os.lstat(run_dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or stat.S_IMODE(st.st_mode) != 0o700:
+        raise PermissionError(errno.EPERM, "Unsafe daemon socket directory", run_dir)
+    return run_dir
+
+
+def _socket_path(db_path: str, name: str) -> str:
+    """
+    Return the socket path of the daemon serving a handler for a database
+    Args:
+        db_path: Keepass database path
+        name: Handler name
+    Returns: str
+    """
+    digest = hashlib.sha256((os.path.realpath(db_path) + '|' + name).encode()).hexdigest()[:16]
+    return os.path.join(_socket_dir(), 'ansible-kp-%s.sock' % digest)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """
+    Receive exactly size bytes from a socket
+    Args:
+        sock: Connected socket
+        size: Number of bytes to receive
+    Returns: bytes
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def _send(sock: socket.socket, message: dict):
+    """
+    Send a length prefixed JSON message
+    Args:
+        sock: Connected socket
+        message: Message to send
+    """
+    data = json.dumps(message).encode()
+    sock.sendall(_HEADER.pack(len(data)) + data)
+
+
+def _recv(sock: socket.socket) -> dict:
+    """
+    Receive a length prefixed JSON message
+    Args:
+        sock: Connected socket
+    Returns: dict
+    """
+    size = _HEADER.unpack(_recv_exact(sock, _HEADER.size))[0]
+    return json.loads(_recv_exact(sock, size).decode())
+
+
+def _connect(sock_path: str) -> socket.socket:
+    """
+    Connect to a daemon socket
+    Args:
+        sock_path: Daemon socket path
+    Returns: socket.socket
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(sock_path)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _lock(sock_path: str) -> int:
+    """
+    Take the lock serializing the start and the stop of the daemon of a socket
+    Args:
+        sock_path: Daemon socket path
+    Returns: int, the locked file descriptor
+    """
+    lock_path = sock_path + '.lock'
+    while True:
+        fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+
+            # Retry if the lock file was removed by an exiting daemon while waiting for it
+            if os.fstat(fd).st_ino == os.stat(lock_path).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        except OSError:
+            os.close(fd)
+            raise
+        os.close(fd)
+
+
+def _unlock(fd: int):
+    """
+    Release a lock taken by _lock
+    Args:
+        fd: Locked file descriptor
+    """
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+
+def _listen(sock_path: str) -> socket.socket:
+    """
+    Bind the daemon socket, must be called with the socket lock held.
+    A socket file is only replaced if no daemon accepts connections on it anymore.
+    Args:
+        sock_path: Daemon socket path
+    Returns: socket.socket
+    """
+    try:
+        _connect(sock_path).close()
+    except FileNotFoundError:
+        pass
+    except ConnectionRefusedError:
+        # Socket left by a dead daemon
+        os.remove(sock_path)
+    else:
+        raise OSError(errno.EADDRINUSE, "Daemon already running", sock_path)
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        listener.bind(sock_path)
+    except OSError:
+        listener.close()
+        raise
+    finally:
+        os.umask(old_umask)
+    listener.listen(16)
+    return listener
+
+
+def _serve(listener: socket.socket, sock_path: str, db_path: str, handler, timeout: int, key_cache: bool):
+    """
+    Serve requests until no request was received during timeout seconds
+    Args:
+        listener: Listening socket
+        sock_path: Daemon socket path
+        db_path: Keepass database path
+        handler: Function called with the database and the request arguments
+        timeout: Idle timeout in seconds
+        key_cache: Persist the transformed key on disk
+    """
+    listener.settimeout(timeout)
+    sock_ino = os.stat(sock_path).st_ino
+    try:
+        while True:
+            try:
+                conn, _ = listener.accept()
+            except socket.timeout:
+                break
+
+            with conn:
+                # Don't let a stalled client keep the daemon alive
+                conn.settimeout(timeout)
+                try:
+                    request = _recv(conn)
+                    db = get_db(db_path, request['password'], key_cache)
+                    response = dict(result=handler(db, *request['args']))
+                except Exception as e:
+                    response = dict(error="%s: %s" % (type(e).__name__, e))
+                try:
+                    _send(conn, response)
+                except OSError:
+                    pass
+    finally:
+        # Only remove the socket if it was not replaced by another daemon
+        lock = _lock(sock_path)
+        try:
+            listener.close()
+            try:
+                if os.stat(sock_path).st_ino == sock_ino:
+                    os.remove(sock_path)
+            except FileNotFoundError:
+                pass
+            os.remove(sock_path + '.lock')
+        finally:
+            _unlock(lock)
+
+
+def _start(listener: socket.socket, sock_path: str, db_path: str, handler, timeout: int, key_cache: bool):
+    """
+    Fork a detached daemon serving the listening socket.
+    The daemon is forked rather than spawned as the module files are removed once the task is done.
+    Args:
+        listener: Listening socket
+        sock_path: Daemon socket path
+        db_path: Keepass database path
+        handler: Function called with the database and the request arguments
+        timeout: Idle timeout in seconds
+        key_cache: Persist the transformed key on disk
+    """
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+
+    # Intermediate child, detach from the module session
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+
+        # Daemon, release everything inherited from the module so ansible does not wait for it
+        os.chdir('/')
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        max_fd = os.sysconf('SC_OPEN_MAX') if hasattr(os, 'sysconf') else 1024
+        os.closerange(3, listener.fileno())
+        os.closerange(listener.fileno() + 1, max_fd)
+
+        _serve(listener, sock_path, db_path, handler, timeout, key_cache)
+    finally:
+        os._exit(0)
+
+
+def call(db_path: str, db_password: str, name: str, handler, args: list, timeout: int = 300,
+         key_cache: bool = False):
+    """
+    Run handler(db, *args) in the daemon keeping the database open, the daemon is started if it is not running.
+    The handler is run locally if the daemon can not be reached.
+    Args:
+        db_path: Keepass database path
+        db_password: Keepass database password
+        name: Handler name, one daemon is started per database and handler
+        handler: Function called with the database and the arguments
+        args: JSON serializable arguments
+        timeout: Daemon idle timeout in seconds
+        key_cache: Persist the transformed key on disk
+    Returns: Handler result
+    """
+    sock = None
+    try:
+        sock_path = _socket_path(db_path, name)
+        try:
+            sock = _connect(sock_path)
+        except (FileNotFoundError, ConnectionRefusedError):
+            # Only one task starts the daemon, the others wait for it and connect
+            lock = _lock(sock_path)
+            try:
+                try:
+                    listener = _listen(sock_path)
+                except OSError as e:
+                    # Another task started the daemon while waiting for the lock
+                    if e.errno != errno.EADDRINUSE:
+                        raise
+                else:
+                    _start(listener, sock_path, db_path, handler, timeout, key_cache)
+                    listener.close()
+            finally:
+                _unlock(lock)
+
+            sock = _connect(sock_path)
+    except OSError:
+        sock = None
+
+    if sock is not None:
+        try:
+            with sock:
+                _send(sock, dict(password=db_password, args=args))
+                response = _recv(sock)
+        except ConnectionError:
+            # The daemon exited on its idle timeout before accepting the request
+            sock = None
+
+    if sock is None:
+        return handler(get_db(db_path, db_password, key_cache), *args)
+
+    if 'error' in response:
+        raise KeePassDaemonError(response['error'])
+    return response['result']
@@ -0,0 +1,181 @@
+# Copyright: (c) 2023, Hasni Mehdi <hasnimehdi@outlook.com>
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+from __future__ import (absolute_import, division, print_function)
+
+import hashlib
+import hmac
+import mmap
+import os
+import struct
+
+from argon2.low_level import Type, hash_secret_raw
+from pykeepass import PyKeePass
+
+__metaclass__ = type
+
+# Argon2id cost of the password fingerprint stored with a transformed key
+_FINGERPRINT_TIME_COST = 2
+_FINGERPRINT_MEMORY_COST = 64 * 1024
+
+# Outer header fields the transformed key depends on
+# KDBX 3: TransformSeed, TransformRounds / KDBX 4: KdfParameters
+_KDF_FIELDS = {
+    3: (5, 6),
+    4: (11,),
+}
+
+
+def _cache_dir() -> str:
+    """
+    Return the directory of the transformed keys
+    Returns: str
+    """
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'ansible-keepass')
+
+
+def _kdf_header(data) -> bytes:
+    """
+    Extract the key derivation parameters from the outer header of a database
+    Args:
+        data: Database content
+    Returns: bytes, None if the header could not be read
+    """
+    if len(data) < 12:
+        return None
+
+    major_version = struct.unpack_from('<H', data, 10)[0]
+    if major_version not in _KDF_FIELDS:
+        return None
+
+    # KDBX 3 uses 16 bits field lengths, KDBX 4 uses 32 bits
+    length_format, length_size = ('<H', 2) if major_version == 3 else ('<I', 4)
+
+    fields = []
+    offset = 12
+    while offset + 1 + length_size <= len(data):
+        field_id = data[offset]
+        length = struct.unpack_from(length_format, data, offset + 1)[0]
+        offset = offset + 1 + length_size
+        if field_id == 0:
+            break
+        if field_id in _KDF_FIELDS[major_version]:
+            fields.append(bytes([field_id]) + bytes(data[offset:offset + length]))
+        offset = offset + length
+    else:
+        return None
+
+    return bytes([major_version]) + b''.join(fields)
+
+
+def _key_file(db_path: str) -> str:
+    """
+    Return the path of the transformed key of a database, a database has a single key file
+    overwritten when its password or key derivation parameters change.
+    Args:
+        db_path: Keepass database path
+    Returns: str
+    """
+    digest = hashlib.sha256(os.path.realpath(db_path).encode()).hexdigest()
+    return os.path.join(_cache_dir(), digest + '.key')
+
+
+def _fingerprint(db_password: str, salt: bytes) -> bytes:
+    """
+    Compute a costed fingerprint of the password binding a transformed key to it,
+    a stolen key file does not provide a fast way to check password guesses.
+    Args:
+        db_password: Keepass database password
+        salt: Random salt stored with the fingerprint
+    Returns: bytes
+    """
+    return hash_secret_raw(db_password.encode(), salt, time_cost=_FINGERPRINT_TIME_COST,
+                           memory_cost=_FINGERPRINT_MEMORY_COST, parallelism=1, hash_len=32, type=Type.ID)
+
+
+def _load_key(key_file: str, kdf_header: bytes, db_password: str) -> bytes:
+    """
+    Read a transformed key, the key is ignored if it was not derived with the given key derivation parameters
+    and password
+    Args:
+        key_file: Transformed key path
+        kdf_header: Key derivation parameters of the database
+        db_password: Keepass database password
+    Returns: bytes, None if there is no valid key
+    """
+    try:
+        with open(key_file, 'rb') as f:
+            content = f.read()
+    except OSError:
+        return None
+
+    # Key derivation parameters digest (32 bytes), transformed key (32 bytes), fingerprint salt (16 bytes),
+    # fingerprint (32 bytes)
+    if len(content) != 112:
+        return None
+    kdf_digest, transformed_key, salt, fingerprint = content[:32], content[32:64], content[64:80], content[80:]
+    if not hmac.compare_digest(kdf_digest, hashlib.sha256(kdf_header).digest()):
+        return None
+    if not hmac.compare_digest(fingerprint, _fingerprint(db_password, salt)):
+        return None
+
+    return transformed_key
+
+
+def _store_key(key_file: str, kdf_header: bytes, transformed_key: bytes, db_password: str):
+    """
+    Write a transformed key readable by the current user only, replacing the previous key of the database
+    Args:
+        key_file: Transformed key path
+        kdf_header: Key derivation parameters of the database
+        transformed_key: Transformed key
+        db_password: Keepass database password
+    """
+    os.makedirs(os.path.dirname(key_file), mode=0o700, exist_ok=True)
+
+    salt = os.urandom(16)
+    tmp = '%s.tmp.%d' % (key_file, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(hashlib.sha256(kdf_header).digest() + transformed_key + salt + _fingerprint(db_password, salt))
+        os.replace(tmp, key_file)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def open_db(mm: mmap.mmap, db_path: str, db_password: str) -> PyKeePass:
+    """
+    Open a Keepass database reusing the transformed key of a previous open when available,
+    the key derivation is only performed when the password or the key derivation parameters change.
+    Args:
+        mm: Memory mapped database positioned at the start of the file
+        db_path: Keepass database path
+        db_password: Keepass database password
+    Returns: PyKeePass
+    """
+    kdf_header = _kdf_header(mm)
+    if kdf_header is None:
+        return PyKeePass(filename=mm, password=db_password)
+
+    key_file = _key_file(db_path)
+    transformed_key = _load_key(key_file, kdf_header, db_password)
+
+    if transformed_key is not None:
+        try:
+            return PyKeePass(filename=mm, password=db_password, transformed_key=transformed_key)
+        except Exception:
+            # Fall back to the full key derivation
+            mm.seek(0)
+
+    db = PyKeePass(filename=mm, password=db_password)
+
+    # A cache that can't be written must not fail the task
+    try:
+        _store_key(key_file, kdf_header, db.transformed_key, db_password)
+    except OSError:
+        pass
+
+    return db
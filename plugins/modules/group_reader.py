@@ -4,6 +4,8 @@
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 from __future__ import (absolute_import, division, print_function)
 
+import os.path
+import re
 import traceback
 from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 
@@ -11,12 +13,21 @@ __metaclass__ = type
 LIB_IMP_ERR = None
 try:
     from pykeepass import PyKeePass
+    from pykeepass.entry import reserved_keys
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_cache import get_db
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_daemon import call
 
     HAS_LIB = True
-except ModuleNotFoundError or NameError:
+except (ImportError, NameError):
     HAS_LIB = False
     LIB_IMP_ERR = traceback.format_exc()
 
+    # Placeholders for the type annotations, the module fails with missing_required_lib
+    PyKeePass = object
+
+# Split a path on one or more slashes
+_SPLIT = re.compile(r'/+').split
+
 DOCUMENTATION = r'''
 ---
 module: group_reader
@@ -38,12 +49,26 @@ options:
         required: true
         type: str
     group_path:
-        description: Keepass group path.
-        required: true
+        description: Keepass group path. Either group_path or group_paths is required.
+        required: false
         type: str
+    group_paths:
+        description: List of Keepass group paths, the database is opened once for all the groups.
+        required: false
+        type: list
+        elements: str
+    fields:
+        description:
+            - List of fields to return for each secret (username, password or custom property names).
+            - If not provided all the fields are returned.
+        required: false
+        type: list
+        elements: str
 author:
     - Hasni Mehdi (@hasnimehdi91)
     - hasnimehdi@outlook.com
+extends_documentation_fragment:
+    - hasnimehdi91.keepass.keepass
 '''
 
 EXAMPLES = r'''
@@ -55,6 +80,27 @@ EXAMPLES = r'''
     group_path: "/foo/bar"
   register: group
 - debug: var=group
+
+# Read only the usernames of the group secrets
+- name: Read group usernames
+  hasnimehdi91.keepass.group_reader:
+    db_path: "keys.kdbx"
+    db_password: "password"
+    group_path: "/foo/bar"
+    fields:
+      - username
+  register: group
+
+# Read several groups at once
+- name: Read groups secrets
+  hasnimehdi91.keepass.group_reader:
+    db_path: "keys.kdbx"
+    db_password: "password"
+    group_paths:
+      - "/foo/bar"
+      - "/foo/baz"
+  register: groups
+- debug: var=groups.groups
 '''
 
 RETURN = r'''
@@ -75,7 +121,11 @@ data:
     group:
         description: List of dict containing the group secrets
         type: [dic]
-        returned: always
+        returned: when group_path is provided
+    groups:
+        description: Dict of group path to the list of dict containing the group secrets
+        type: dict
+        returned: when group_paths is provided
 '''
 
 
@@ -84,74 +134,109 @@ def run_module():
     Keepass group_reader module
     Returns:
     """
-    group_secret_dic = dict()
+    group_secret_dic = None
+    groups_secret_dic = None
 
     # Keepass group_reader module arguments
     module_args = dict(
         db_path=dict(type='str', required=True),
         db_password=dict(type='str', required=True, no_log=True),
-        group_path=dict(type='str', required=True),
+        group_path=dict(type='str', required=False),
+        group_paths=dict(type='list', elements='str', required=False),
+        fields=dict(type='list', elements='str', required=False),
+        key_cache=dict(type='bool', required=False, default=False, no_log=False),
+        daemon=dict(type='bool', required=False, default=False),
+        daemon_timeout=dict(type='int', required=False, default=300),
     )
 
     # Keepass module result initialization
-    result = dict(
-        changed=True,
-        group=group_secret_dic,
-        failed=False
-    )
+    result = {"changed": True, "failed": False, "group": None}
 
     # Keepass module initialization
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('group_path', 'group_paths')],
+        mutually_exclusive=[('group_path', 'group_paths')],
         supports_check_mode=True
     )
 
+    # Validate inputs before paying the database key derivation
+    group_paths = module.params['group_paths'] or [module.params['group_path']]
+    if not all(p and p.strip() for p in group_paths):
+        module.fail_json(msg="group_path is required")
+    if not os.path.isfile(module.params['db_path']):
+        module.fail_json(msg="Keepass database %s does not exist" % module.params['db_path'])
+
     if not HAS_LIB:
         module.fail_json(msg=missing_required_lib("pykeepass"), exception=LIB_IMP_ERR)
 
     # Return module result
     if module.check_mode:
+        if module.params['group_paths']:
+            del result['group']
+            result['groups'] = {}
+        else:
+            result['group'] = {}
         module.exit_json(**result)
 
     try:
         db_path = module.params['db_path']
         db_password = module.params['db_password']
-        db = PyKeePass(filename=db_path, password=db_password)
-
-        group_secret_dic = group_to_dic(db, module.params['group_path'])
+        args = [group_paths, module.params['fields']]
+
+        if module.params['daemon']:
+            groups_secret_dic = call(db_path, db_password, 'group_reader', groups_to_dic, args,
+                                     module.params['daemon_timeout'], module.params['key_cache'])
+        else:
+            db = get_db(db_path, db_password, module.params['key_cache'])
+            groups_secret_dic = groups_to_dic(db, *args)
     except Exception as e:
-        module.fail_json(msg="Failed to read keepass group secrets", exception=e)
+        module.fail_json(msg="Failed to read keepass group secrets: %s" % e, exception=traceback.format_exc())
 
-    result['group'] = group_secret_dic
-    result['path'] = module.params['group_path']
+    if module.params['group_paths']:
+        del result['group']
+        result['groups'] = groups_secret_dic or {}
+    else:
+        group_secret_dic = groups_secret_dic[module.params['group_path']]
+        result['group'] = group_secret_dic or []
+        result['path'] = module.params['group_path']
 
     # Exit with result
     module.exit_json(**result)
 
 
-def group_to_dic(db: PyKeePass, group_path: str) -> dict:
+def groups_to_dic(db: PyKeePass, group_paths: list, fields: list = None) -> dict:
+    """
+    Read the secrets of several groups from the same opened database
+    Args:
+        db: Keepass database
+        group_paths: Groups paths
+        fields: Fields to read from each secret, all fields are read if None
+    Returns: dict
+    """
+    return {p: group_to_dic(db, p, fields) for p in group_paths}
+
+
+def group_to_dic(db: PyKeePass, group_path: str, fields: list = None) -> dict:
     """
     Read group secrets from Keepass and convert them to  list of dictionary [dic]
     Args:
         db: Keepass database
         group_path: Secret path
+        fields: Fields to read from each secret, all fields are read if None
     Returns: [dic]
     """
     # Init group secrets list
     group_secrets = []
 
     # Check if the groups path was provided
-    if group_path is None or group_path == '' or group_path.isspace():
-        raise ValueError("secret_path is required")
+    if not (group_path and group_path.strip()):
+        raise ValueError("group_path is required")
 
-    # Extract group path
-    path = group_path.split("/")
-
-    # Remove white spaces
-    if path is not None and len(path) > 0:
-        path = [e for e in path if e]
-    else:
-        return group_secrets
+    # Extract group path, "/" is the root group
+    path = _SPLIT(group_path.strip('/'))
+    if path == ['']:
+        path = []
 
     # Find group
     group = db.find_groups(path=path, first=True)
@@ -163,24 +248,22 @@ def group_to_dic(db: PyKeePass, group_path: str) -> dict:
     # Extract entries
     entries = group.entries
 
-    # Find all entries and map them to dict and then append them to the group list
+    # Find all entries and map them to dict and then append them to the group list,
+    # the strings of each entry are read in a single pass over its element instead of one lookup per field
     for entry in entries:
-        secret = dict()
-        entry = db.find_entries_by_path(path=entry.path)
-        if entry is None:
-            continue
-
-        secret[entry.path[-1]] = dict()
-
-        if entry.username:
-            secret[entry.path[-1]]["username"] = entry.username
-        if entry.password:
-            secret[entry.path[-1]]["password"] = entry.password
-
-        if entry.custom_properties and type(entry.custom_properties) is dict:
-            for k in entry.custom_properties:
-                secret[entry.path[-1]][k] = entry.custom_properties[k]
-        group_secrets.append(secret)
+        title = entry.path[-1]
+        strings = {string.find('Key').text: string.find('Value').text for string in entry._element.iterfind('String')}
+        bucket = dict()
+
+        if (fields is None or "username" in fields) and strings.get("UserName"):
+            bucket["username"] = strings["UserName"]
+        if (fields is None or "password" in fields) and strings.get("Password"):
+            bucket["password"] = strings["Password"]
+
+        for k, v in strings.items():
+            if k not in reserved_keys and (fields is None or k in fields):
+                bucket[k] = v
+        group_secrets.append({title: bucket})
 
     return group_secrets
 
@@ -4,6 +4,8 @@
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 from __future__ import (absolute_import, division, print_function)
 
+import os.path
+import re
 import traceback
 from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 
@@ -11,12 +13,20 @@ __metaclass__ = type
 LIB_IMP_ERR = None
 try:
     from pykeepass import PyKeePass
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_cache import get_db
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_daemon import call
 
     HAS_LIB = True
-except ModuleNotFoundError or NameError:
+except (ImportError, NameError):
     HAS_LIB = False
     LIB_IMP_ERR = traceback.format_exc()
 
+    # Placeholders for the type annotations, the module fails with missing_required_lib
+    PyKeePass = object
+
+# Split a path on one or more slashes
+_SPLIT = re.compile(r'/+').split
+
 DOCUMENTATION = r'''
 ---
 module: secret_reader
@@ -43,6 +53,8 @@ options:
 author:
     - Hasni Mehdi (@hasnimehdi91)
     - hasnimehdi@outlook.com
+extends_documentation_fragment:
+    - hasnimehdi91.keepass.keepass
 '''
 
 EXAMPLES = r'''
@@ -83,21 +95,20 @@ def run_module():
     Keepass secret_reader module
     Returns:
     """
-    secret_dic = dict()
+    secret_dic = None
 
     # Keepass secret_reader module arguments
     module_args = dict(
         db_path=dict(type='str', required=True),
         db_password=dict(type='str', required=True, no_log=True),
         secret_path=dict(type='str', required=True),
+        key_cache=dict(type='bool', required=False, default=False, no_log=False),
+        daemon=dict(type='bool', required=False, default=False),
+        daemon_timeout=dict(type='int', required=False, default=300),
     )
 
     # Keepass module result initialization
-    result = dict(
-        changed=True,
-        secret=secret_dic,
-        failed=False
-    )
+    result = {"changed": True, "failed": False, "secret": None}
 
     # Keepass module initialization
     module = AnsibleModule(
@@ -105,23 +116,35 @@ def run_module():
         supports_check_mode=True
     )
 
+    # Validate inputs before paying the database key derivation
+    if not (module.params['secret_path'] or '').strip('/ \t\n'):
+        module.fail_json(msg="secret_path is required")
+    if not os.path.isfile(module.params['db_path']):
+        module.fail_json(msg="Keepass database %s does not exist" % module.params['db_path'])
+
     if not HAS_LIB:
         module.fail_json(msg=missing_required_lib("pykeepass"), exception=LIB_IMP_ERR)
 
     # Return module result
     if module.check_mode:
+        result['secret'] = {}
         module.exit_json(**result)
 
     try:
         db_path = module.params['db_path']
         db_password = module.params['db_password']
-        db = PyKeePass(filename=db_path, password=db_password)
-
-        secret_dic = secret_to_dic(db, module.params['secret_path'])
+        args = [module.params['secret_path']]
+
+        if module.params['daemon']:
+            secret_dic = call(db_path, db_password, 'secret_reader', secret_to_dic, args,
+                              module.params['daemon_timeout'], module.params['key_cache'])
+        else:
+            db = get_db(db_path, db_password, module.params['key_cache'])
+            secret_dic = secret_to_dic(db, *args)
     except Exception as e:
-        module.fail_json(msg="Failed to read keepass secret", exception=e)
+        module.fail_json(msg="Failed to read keepass secret: %s" % e, exception=traceback.format_exc())
 
-    result['secret'] = secret_dic
+    result['secret'] = secret_dic or {}
     result['path'] = module.params['secret_path']
 
     # Exit with result
@@ -141,15 +164,13 @@ def secret_to_dic(db: PyKeePass, secret_path: str) -> dict:
     secret = dict()
 
     # Check if path is not provided
-    if secret_path is None or secret_path == '' or secret_path.isspace():
+    if not (secret_path and secret_path.strip()):
         raise ValueError("secret_path is required")
-    path = secret_path.split("/")
 
-    # Remove white spaces
-    if path is not None and len(path) > 0:
-        path = [e for e in path if e]
-    else:
-        return secret
+    # Extract secret path
+    path = _SPLIT(secret_path.strip('/'))
+    if not path or path == ['']:
+        raise ValueError("secret_path must contain a secret name")
 
     # Find secret
     entry = db.find_entries_by_path(path=path)
@@ -158,20 +179,20 @@ def secret_to_dic(db: PyKeePass, secret_path: str) -> dict:
     if entry is None:
         return secret
 
-    # Append secret key
-    secret[path[-1]] = dict()
+    title = entry.path[-1] if entry.path else path[-1]
+    bucket = dict()
 
     # Append secret username, password and extra attributes
     if entry.username:
-        secret[path[-1]]["username"] = entry.username
+        bucket["username"] = entry.username
     if entry.password:
-        secret[path[-1]]["password"] = entry.password
-    if entry.custom_properties and type(entry.custom_properties) is dict:
-        for k in entry.custom_properties:
-            secret[path[-1]][k] = entry.custom_properties[k]
+        bucket["password"] = entry.password
+    cp = entry.custom_properties
+    if isinstance(cp, dict):
+        bucket.update(cp)
 
     # Return secret
-    return secret
+    return {title: bucket}
 
 
 def main():
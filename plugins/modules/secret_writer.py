@@ -4,21 +4,35 @@
 # GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
 from __future__ import (absolute_import, division, print_function)
 
+import hashlib
 import os.path
+import re
 import traceback
+from collections import deque
 
 from ansible.module_utils.basic import AnsibleModule, missing_required_lib
 
 __metaclass__ = type
 LIB_IMP_ERR = None
 try:
+    from lxml import etree
     from pykeepass import PyKeePass, create_database
+    from pykeepass.entry import Entry, reserved_keys
+    from pykeepass.group import Group
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_cache import get_db, invalidate_db, update_db
+    from ansible_collections.hasnimehdi91.keepass.plugins.module_utils.kp_daemon import call
 
     HAS_LIB = True
-except ModuleNotFoundError or NameError:
+except (ImportError, NameError):
     HAS_LIB = False
     LIB_IMP_ERR = traceback.format_exc()
 
+    # Placeholders for the type annotations, the module fails with missing_required_lib
+    PyKeePass = Group = Entry = object
+
+# Split a path on one or more slashes
+_SPLIT = re.compile(r'/+').split
+
 DOCUMENTATION = r'''
 ---
 module: secret_writer
@@ -41,8 +55,8 @@ options:
         required: true
         type: str
     secret_path:
-        description: Keepass secret path.
-        required: true
+        description: Keepass secret path. Either secret_path or secrets is required.
+        required: false
         type: str
     secret_value:
         description: dict containing the secret data. If not provided a empty secret will be created.
@@ -64,6 +78,37 @@ options:
             description: Secret custom properties
             type: dict
             required: false
+    secrets:
+        description:
+            - List of secrets to write, the database is opened and saved once for all the secrets.
+        required: false
+        type: list
+        elements: dict
+        suboptions:
+            path:
+                description: Keepass secret path.
+                required: true
+                type: str
+            username:
+                description: Secret username
+                type: str
+                required: false
+            password:
+                description: Secret password
+                type: str
+                required: false
+            url:
+                description: Secret url
+                type: str
+                required: false
+            custom_properties:
+                description: Secret custom properties
+                type: dict
+                required: false
+            force:
+                description: If set to true the secret will be overridden, defaults to the force option.
+                type: bool
+                required: false
     force:
         description: If set to true the secret will be overridden
         required: false
@@ -72,6 +117,8 @@ options:
 author:
     - Hasni Mehdi (@hasnimehdi91)
     - hasnimehdi@outlook.com
+extends_documentation_fragment:
+    - hasnimehdi91.keepass.keepass
 '''
 
 EXAMPLES = r'''
@@ -95,6 +142,22 @@ EXAMPLES = r'''
     force: false
   register: created_secret
 - debug: var=created_secret
+
+# Write several secrets at once
+- name: Write secrets
+  hasnimehdi91.keepass.secret_writer:
+    db_path: "keys.kdbx"
+    db_password: "password"
+    secrets:
+      - path: "/foo/bar"
+        username: "John"
+        password: "Doe"
+      - path: "/foo/baz"
+        username: "Jane"
+        password: "Doe"
+        force: true
+  register: created_secrets
+- debug: var=created_secrets.secrets
 '''
 
 RETURN = r'''
@@ -115,7 +178,11 @@ data:
     secret:
         description: Dictionary containing the secret data
         type: dict
-        returned: always
+        returned: when secret_path is provided
+    secrets:
+        description: List of dict containing the path, the data and the changed state of each secret
+        type: list
+        returned: when secrets is provided
 '''
 
 
@@ -124,14 +191,15 @@ def run_module():
     Keepass secret_writer module
     Returns:
     """
-    secret_dic = dict()
+    secret_dic = None
+    secrets_dic = None
     changed = False
 
     # Keepass secret_writer module arguments
     module_args = dict(
         db_path=dict(type='str', required=True),
         db_password=dict(type='str', required=True, no_log=False),
-        secret_path=dict(type='str', required=True),
+        secret_path=dict(type='str', required=False),
         secret_value=dict(
             type='dict',
             required=False,
@@ -141,27 +209,54 @@ def run_module():
             url=dict(type='str', required=False),
             custom_properties=dict(type='dict', required=False)
         ),
-        force=dict(type='bool', required=False, default=False)
+        secrets=dict(
+            type='list',
+            elements='dict',
+            required=False,
+            options=dict(
+                path=dict(type='str', required=True),
+                username=dict(type='str', required=False),
+                password=dict(type='str', required=False, no_log=True),
+                url=dict(type='str', required=False),
+                custom_properties=dict(type='dict', required=False),
+                force=dict(type='bool', required=False)
+            )
+        ),
+        force=dict(type='bool', required=False, default=False),
+        key_cache=dict(type='bool', required=False, default=False, no_log=False),
+        daemon=dict(type='bool', required=False, default=False),
+        daemon_timeout=dict(type='int', required=False, default=300)
     )
 
     # Keepass module result initialization
-    result = dict(
-        changed=False,
-        secret=secret_dic,
-        failed=False
-    )
+    result = {"changed": False, "failed": False, "secret": None}
 
     # Keepass module initialization
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('secret_path', 'secrets')],
+        mutually_exclusive=[('secret_path', 'secrets')],
         supports_check_mode=True
     )
 
+    # Validate inputs before paying the database key derivation
+    if module.params['secrets']:
+        secret_paths = [item['path'] for item in module.params['secrets']]
+    else:
+        secret_paths = [module.params['secret_path']]
+    if not all(p and p.strip('/ \t\n') for p in secret_paths):
+        module.fail_json(msg="secret_path is required")
+
     if not HAS_LIB:
         module.fail_json(msg=missing_required_lib("pykeepass"), exception=LIB_IMP_ERR)
 
     # Return module result
     if module.check_mode:
+        if module.params['secrets']:
+            del result['secret']
+            result['secrets'] = []
+        else:
+            result['secret'] = {}
         module.exit_json(**result)
 
     try:
@@ -172,44 +267,112 @@ def run_module():
         if not os.path.isfile(db_path):
             create_database(db_path, db_password)
 
-        # Connect to database
-        db = PyKeePass(filename=db_path, password=db_password)
-
-        # Init secret username
-        secret_username = module.params['secret_value']['username'] if (
-                ('secret_value' in module.params) and ('username' in module.params['secret_value'])) else None
-
-        # Init secret password
-        secret_password = module.params['secret_value']['password'] if (
-                ('secret_value' in module.params) and ('password' in module.params['secret_value'])) else None
-
-        # Init secret url
-        secret_url = module.params['secret_value']['url'] if (
-                ('secret_value' in module.params) and ('url' in module.params['secret_value'])) else None
-
-        # Init secret custom_properties
-        secret_custom_properties = module.params['secret_value']['custom_properties'] if (
-                ('secret_value' in module.params) and ('custom_properties' in module.params['secret_value'])) else None
-
         # Init force override
         force = True if (('force' in module.params) and (module.params['force'] is True)) else False
 
-        secret_dic, changed = secret_write(secret_path=module.params['secret_path'], db=db, db_path=db_path,
-                                           username=secret_username, password=secret_password, url=secret_url,
-                                           custom_properties=secret_custom_properties, force=force)
+        # A single secret is written as a list of one secret
+        secrets = module.params['secrets'] or [_module_secret(module)]
+        args = [db_path, db_password, secrets, force]
+
+        if module.params['daemon']:
+            secrets_dic, changed = call(db_path, db_password, 'secret_writer', write_secrets, args,
+                                        module.params['daemon_timeout'], module.params['key_cache'])
+        else:
+            # Connect to database
+            db = get_db(db_path, db_password, module.params['key_cache'])
+            secrets_dic, changed = write_secrets(db, *args)
     except Exception as e:
-        module.fail_json(msg="Failed to write keepass secret", exception=e)
+        module.fail_json(msg="Failed to write keepass secret: %s" % e, exception=traceback.format_exc())
 
-    result['secret'] = secret_dic
+    if module.params['secrets']:
+        del result['secret']
+        result['secrets'] = secrets_dic
+    else:
+        secret_dic = secrets_dic[0]['secret']
+        result['secret'] = secret_dic or {}
+        result['path'] = module.params['secret_path']
     result['changed'] = changed is True
-    result['path'] = module.params['secret_path']
 
     # Exit with result
     module.exit_json(**result)
 
 
+def _module_secret(module: AnsibleModule) -> dict:
+    """
+    Build the secret described by the secret_path and secret_value module parameters
+    Args:
+        module: Keepass secret_writer module
+    Returns: dict
+    """
+    # Init secret username
+    secret_username = module.params['secret_value']['username'] if (
+            ('secret_value' in module.params) and ('username' in module.params['secret_value'])) else None
+
+    # Init secret password
+    secret_password = module.params['secret_value']['password'] if (
+            ('secret_value' in module.params) and ('password' in module.params['secret_value'])) else None
+
+    # Init secret url
+    secret_url = module.params['secret_value']['url'] if (
+            ('secret_value' in module.params) and ('url' in module.params['secret_value'])) else None
+
+    # Init secret custom_properties
+    secret_custom_properties = module.params['secret_value']['custom_properties'] if (
+            ('secret_value' in module.params) and ('custom_properties' in module.params['secret_value'])) else None
+
+    return dict(path=module.params['secret_path'], username=secret_username, password=secret_password,
+                url=secret_url, custom_properties=secret_custom_properties)
+
+
+def write_secrets(db: PyKeePass, db_path: str, db_password: str, secrets: list, force: bool) -> (list, bool):
+    """
+    Write a list of secrets to Keepass and save the database once
+    Args:
+        db: Keepass database
+        db_path: Database path
+        db_password: Database password
+        secrets: List of dict containing the path, username, password, url, custom_properties and force of the secrets
+        force: Indicates if the secrets should be replaced if they exist or not, unless set per secret.
+    Returns: (list, bool)
+    """
+    secrets_dic = []
+    try:
+        # Index the groups once for all the secrets
+        group_index = _index_groups(db)
+
+        for item in secrets:
+            item_dic, item_changed = secret_write(secret_path=item.get('path'), db=db, db_path=db_path,
+                                                  username=item.get('username'), password=item.get('password'),
+                                                  url=item.get('url'), custom_properties=item.get('custom_properties'),
+                                                  force=force if item.get('force') is None else item['force'],
+                                                  save=False, group_index=group_index)
+            secrets_dic.append(dict(path=item.get('path'), secret=item_dic, changed=item_changed))
+
+        changed = any(item['changed'] for item in secrets_dic)
+        if changed:
+            db.save(db_path)
+
+            # Flush the database to disk once for the whole batch
+            fd = os.open(db_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    except Exception:
+        # Don't keep the partially written handle, the next access reloads the database from disk
+        invalidate_db(db_path, db_password)
+        raise
+
+    # Keep the cached database handle valid after saving
+    if changed:
+        update_db(db_path, db_password, db)
+
+    return secrets_dic, changed
+
+
 def secret_write(secret_path: str, db: PyKeePass, db_path: str, username: str = None, password: str = None,
-                 url: str = None, custom_properties: dict = None, force: bool = False) -> (dict, bool):
+                 url: str = None, custom_properties: dict = None, force: bool = False,
+                 save: bool = True, group_index: dict = None) -> (dict, bool):
     """
     Write a secret to Keepass and return its data as a dict
     Args:
@@ -222,121 +385,153 @@ def secret_write(secret_path: str, db: PyKeePass, db_path: str, username: str =
         url: Secret url
         custom_properties: Secret custom properties
         force: Indicates if the secret should be replaced if it exists or not.
+        save: Save the database after writing the secret
+        group_index: Groups indexed by path, built from the database if not provided
     Returns: dict
     """
 
     # Check if secret path was not provided
-    if secret_path is None or secret_path == '' or secret_path.isspace():
+    if not (secret_path and secret_path.strip()):
         raise ValueError("secret_path is required")
 
-    path = secret_path.split("/")
-
-    # Remove white spaces
-    if path is not None and len(path) > 1:
-        path = [e for e in path if e]
+    # Extract secret path
+    path = _SPLIT(secret_path.strip('/'))
+    if not path or path == ['']:
+        raise ValueError("secret_path must contain a secret name")
+    title = path[-1]
 
-    # Write the secret in the root group if the path has no groups
-    elif len(path) == 1:
-        # Fetch entry
-        entry = db.find_entries_by_path(path=path)
-
-        if entry is not None and not force:
-            # Return entry of it exists and not forced to be replaced
-            return _convert_secret_to_dic(path, entry, False)
-        elif entry is not None and force:
-            # Replace entry it is forced
-            db.delete_entry(entry)
-            entry = db.add_entry(destination_group=db.root_group, title=path[len(path) - 1], username=username, password=password,
-                                 url=url, force_creation=True)
-            if custom_properties is not None and type(custom_properties) is dict:
-                for k in custom_properties:
-                    entry.set_custom_property(key=str(k), value=str(custom_properties[k]))
-            db.save(db_path)
-            return _convert_secret_to_dic(path, entry, True)
-        else:
-            # Create new secret
-            entry = db.add_entry(destination_group=db.root_group, title=path[len(path) - 1], username=username, password=password,
-                                 url=url, force_creation=True)
-            if custom_properties and type(custom_properties) is dict:
-                for k in custom_properties:
-                    entry.set_custom_property(key=str(k), value=str(custom_properties[k]))
-            db.save(db_path)
-            return _convert_secret_to_dic(path, entry, True)
-    else:
-        return None, False
+    # Reject custom properties overriding the entry fields
+    reserved = [str(k) for k in (custom_properties or {}) if str(k) in reserved_keys]
+    if reserved:
+        raise ValueError("custom_properties can not contain reserved keys: %s" % ", ".join(reserved))
 
-    # Init group path
-    group_path = []
+    # Init parent group, the secret is written in the root group if the path has no groups
+    parent_group = db.root_group
 
-    # Init parent group
-    parent_group = None
+    if len(path) > 1:
+        # Index groups by path
+        if group_index is None:
+            group_index = _index_groups(db)
 
-    # Init depth counter
-    i = 0
+        # Init group path
+        group_path = []
 
-    # Create parent and subsequent groups if they don't exist and then create the secret
-    for item in path:
-        group_path.append(item)
-        # Break on the last item as it is the secret name
-        if item == path[len(path) - 1] and i == (len(path) - 1):
-            break
+        # Create parent and subsequent groups if they don't exist and then create the secret,
+        # the last item is the secret name
+        for item in path[:-1]:
+            group_path.append(item)
 
-        # Fetch group
-        group = db.find_groups(path=group_path, first=True)
+            # Fetch group
+            group = group_index.get(tuple(group_path))
 
-        # Create group if it does not exist and move to next node
-        if group is None:
-            if parent_group is None:
-                parent_group = db.root_group
-            parent_group = db.add_group(destination_group=parent_group, group_name=item)
-        else:
+            # Create group if it does not exist and move to next node
+            if group is None:
+                group = db.add_group(destination_group=parent_group, group_name=item)
+                group_index[tuple(group_path)] = group
             parent_group = group
-        i = i + 1
 
     # Fetch entry
-    entry = db.find_entries_by_path(path=path)
+    entry = next((e for e in parent_group.entries if e.title == title), None)
 
     if entry is not None and not force:
         # Return entry of it exists and not forced to be replaced
         return _convert_secret_to_dic(path, entry, False)
     elif entry is not None and force:
+        # Keep the entry untouched if it already holds the same secret
+        if _entry_signature(entry.username, entry.password, entry.url, entry.custom_properties) == \
+                _entry_signature(username, password, url, custom_properties):
+            return _convert_secret_to_dic(path, entry, False)
+
         # Replace entry it is forced
         db.delete_entry(entry)
 
-        entry = db.add_entry(destination_group=parent_group, title=path[len(path) - 1], username=username, password=password,
-                             url=url)
-        if custom_properties and type(custom_properties) is dict:
-            for k in custom_properties:
-                entry.set_custom_property(key=str(k), value=str(custom_properties[k]))
-        db.save(db_path)
-    else:
-        # Create new secret
-        entry = db.add_entry(destination_group=parent_group, title=path[len(path) - 1], username=username, password=password,
-                             url=url)
-        if custom_properties and type(custom_properties) is dict:
-            for k in custom_properties:
-                entry.set_custom_property(key=str(k), value=str(custom_properties[k]))
-        db.save(db_path)
+    # Create new secret
+    entry = _write_entry(db, parent_group, title, username, password, url, custom_properties, db_path, save)
 
     return _convert_secret_to_dic(path, entry, True)
 
 
+def _write_entry(db: PyKeePass, parent: Group, title: str, username: str, password: str, url: str,
+                 custom_properties: dict, db_path: str, save: bool = True) -> Entry:
+    """
+    Add an entry with its custom properties to a group and save the database
+    Args:
+        db: Keepass database
+        parent: Parent group
+        title: Secret title
+        username: Secret username
+        password: Secret password
+        url: Secret url
+        custom_properties: Secret custom properties
+        db_path: Database path
+        save: Save the database after adding the entry
+    Returns: Entry
+    """
+    # Omitted username and password are stored as empty strings
+    entry = db.add_entry(destination_group=parent, title=title, username='' if username is None else username,
+                         password='' if password is None else password, url=url, force_creation=True)
+
+    # Append all the custom properties to the entry element at once
+    if custom_properties and isinstance(custom_properties, dict):
+        element = entry._element
+        for k, v in custom_properties.items():
+            string = etree.SubElement(element, 'String')
+            etree.SubElement(string, 'Key').text = str(k)
+            etree.SubElement(string, 'Value').text = str(v)
+
+    if save:
+        db.save(db_path)
+
+    return entry
+
+
+def _entry_signature(username: str, password: str, url: str, custom_properties: dict) -> bytes:
+    """
+    Compute the signature of a secret content
+    Args:
+        username: Secret username
+        password: Secret password
+        url: Secret url
+        custom_properties: Secret custom properties
+    Returns: bytes
+    """
+    properties = sorted((str(k), str(v)) for k, v in (custom_properties or {}).items() if str(k) not in reserved_keys)
+    return hashlib.blake2b(repr((username or '', password or '', url or '', properties)).encode()).digest()
+
+
+def _index_groups(db: PyKeePass) -> dict:
+    """
+    Walk the database groups once and index them by path
+    Args:
+        db: Keepass database
+    Returns: dict
+    """
+    group_index = dict()
+
+    queue = deque([db.root_group])
+    while queue:
+        group = queue.popleft()
+        group_index.setdefault(tuple(group.path), group)
+        queue.extend(group.subgroups)
+
+    return group_index
+
+
 def _convert_secret_to_dic(path: [], entry: dict, changed: bool) -> (dict, bool):
-    secret = dict()
-    # Append secret key
-    secret[path[-1]] = dict()
+    title = entry.path[-1] if entry.path else path[-1]
+    bucket = dict()
 
     # Append secret username, password and extra attributes
     if entry.username:
-        secret[path[-1]]["username"] = entry.username
+        bucket["username"] = entry.username
     if entry.password:
-        secret[path[-1]]["password"] = entry.password
-    if entry.custom_properties and type(entry.custom_properties) is dict:
-        for k in entry.custom_properties:
-            secret[path[-1]][k] = entry.custom_properties[k]
+        bucket["password"] = entry.password
+    cp = entry.custom_properties
+    if isinstance(cp, dict):
+        bucket.update(cp)
 
     # Return secret
-    return secret, changed
+    return {title: bucket}, changed
 
 
 def main():